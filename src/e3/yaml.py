@@ -3,9 +3,13 @@
 
 from __future__ import annotations
 
+import copy
+import logging
+import operator
 import os
 import re
-from collections import OrderedDict
+import sys
+from collections import ChainMap
 from typing import TYPE_CHECKING
 
 import yaml
@@ -13,34 +17,98 @@ import yaml.constructor
 import yaml.parser
 
 import e3.log
-from e3.text import format_with_dict
 
 if TYPE_CHECKING:
     # Conditonal imports do not work with mypy, unconditionaly use yaml.Loader
     # for type checking
-    from typing import Any, IO
+    from typing import Any, Callable, IO, Optional
+    from collections.abc import Iterator
     from yaml import Loader
+
+    # The absolute path of a file with its modification time and size
+    FileSignature = tuple[str, Optional[tuple[int, int]]]
 else:
+    # Prefer the libyaml based loader: scanning and parsing of the yaml
+    # stream is then done in C, which is much faster than the pure Python
+    # implementation.
     try:
         from yaml import CLoader as Loader
     except ImportError:
         from yaml import Loader
 
+logger = e3.log.getLogger("yaml")
+
+if not yaml.__with_libyaml__:  # all: no cover
+    logger.warning(
+        "libyaml is not available, falling back to the (slower) pure Python"
+        " yaml loader"
+    )
+
+
+# Match the %(key) references in a template string
+FORMAT_KEY_RE = re.compile(r"%\(([^)]*)\)")
+
+
+# Tags of the mapping keys that are handled by flatten_mapping
+FLATTEN_TAGS = frozenset(("tag:yaml.org,2002:merge", "tag:yaml.org,2002:value"))
+
+
+STR_TAG = "tag:yaml.org,2002:str"
+
+# Match the integers that can be converted directly with int()
+DECIMAL_INT_RE = re.compile(r"[-+]?(?:0|[1-9][0-9]*)\Z")
+
+# Operators used to update the current value of a key, indexed by whether
+# the key starts and ends with a '+'
+UPDATE_OPERATORS: dict[tuple[bool, bool], tuple[str, Callable[[Any, Any], Any]]] = {
+    (True, False): ("append", operator.add),
+    (True, True): ("append", operator.add),
+    (False, True): ("prepend", lambda current, value: value + current),
+}
+
+# Cache of the files loaded through !include, indexed by absolute path. Each
+# entry contains the signatures at load time of the file and of all the files
+# it includes, and the loaded data, which must never be returned directly
+# (always return a copy).
+_INCLUDE_CACHE: dict[str, tuple[tuple[FileSignature, ...], Any]] = {}
+
+
+def _file_signature(path: str) -> FileSignature:
+    """Return the signature used to detect modifications of a file.
+
+    :param path: an absolute path
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (path, None)
+    return (path, (st.st_mtime_ns, st.st_size))
+
 
 class YamlError(Exception):
     pass
 
 
 class OrderedDictYAMLLoader(Loader):
-    """A YAML loader that loads mappings into ordered dictionaries.
+    """A YAML loader that loads mappings into dictionaries preserving order.
 
     The loader also support the !include constructor that allows
     inclusion of yaml files into another yaml
     """
 
-    def __init__(self, stream: IO[str]):
-        self.name = None
-        self.stream = stream
+    def __init__(self, stream: str | bytes | IO[str] | IO[bytes]):
+        self.name = getattr(stream, "name", None)
+
+        # Signatures of the files included in the loaded document
+        self.dependencies: list[FileSignature] = []
+
+        # Files included with !include are relative to the directory of the
+        # loaded file, if any
+        if isinstance(self.name, str) and os.path.isfile(self.name):
+            self.include_dir = os.path.dirname(self.name)
+        else:
+            self.include_dir = ""
+
         super().__init__(stream)
 
         self.add_constructor(
@@ -49,31 +117,80 @@ class OrderedDictYAMLLoader(Loader):
         self.add_constructor(
             "tag:yaml.org,2002:omap", type(self).construct_yaml_map
         )  # type: ignore
+        self.add_constructor(STR_TAG, type(self).construct_yaml_str)  # type: ignore
+        self.add_constructor(
+            "tag:yaml.org,2002:int", type(self).construct_yaml_int
+        )  # type: ignore
         self.add_constructor("!include", type(self).yaml_include)  # type: ignore
 
-    def yaml_include(self, node):
-        # Get the path out of the yaml file
-        if self.name is None:
-            if not isinstance(self.stream, str) or isinstance(self.stream, str):
-                self.name = getattr(self.stream, "name", None)
-
-        if self.name is not None and os.path.isfile(self.name):
-            file_name = os.path.join(os.path.dirname(self.name), node.value)
-        else:
-            file_name = node.value
+    def construct_yaml_str(self, node):
+        # Scalars are the most common nodes, avoid going through
+        # construct_scalar for them. Short strings, which include most of
+        # the mapping keys, are interned as they are often repeated.
+        if isinstance(node, yaml.ScalarNode):
+            value = node.value
+            if len(value) < 64 and value.isascii():
+                return sys.intern(value)
+            return value
+        return super().construct_yaml_str(node)
+
+    def construct_yaml_int(self, node):
+        # Handle plain decimal integers directly, other forms (octal,
+        # hexadecimal, sexagesimal, ...) are left to the default constructor
+        if isinstance(node, yaml.ScalarNode) and DECIMAL_INT_RE.match(node.value):
+            return int(node.value)
+        return super().construct_yaml_int(node)
 
+    def yaml_include(self, node):
+        file_name = os.path.join(self.include_dir, node.value)
+
+        features = os.environ.get("E3_ENABLE_FEATURE", "").split(",")
+        if "no-yaml-include-cache" in features:
+            with open(file_name, "rb") as inputfile:
+                return yaml.load(inputfile, OrderedDictYAMLLoader)
+
+        # Files are usually included from several places, cache their
+        # content as long as neither them nor the files they include are
+        # modified. Modifications are detected using the modification times
+        # and sizes of the files.
+        abs_path = os.path.abspath(file_name)
+        cached = _INCLUDE_CACHE.get(abs_path)
+        if cached is not None and all(
+            _file_signature(sig[0]) == sig for sig in cached[0]
+        ):
+            self.dependencies.extend(cached[0])
+            return copy.deepcopy(cached[1])
+
+        signature = _file_signature(abs_path)
         with open(file_name, "rb") as inputfile:
-            return yaml.load(inputfile, OrderedDictYAMLLoader)
+            loader = OrderedDictYAMLLoader(inputfile)
+            try:
+                result = loader.get_single_data()
+            finally:
+                loader.dispose()
+        dependencies = (signature, *loader.dependencies)
+        self.dependencies.extend(dependencies)
+
+        try:
+            _INCLUDE_CACHE[abs_path] = (dependencies, copy.deepcopy(result))
+        except (TypeError, copy.Error):
+            # The file contains python objects that cannot be copied, do not
+            # cache it
+            _INCLUDE_CACHE.pop(abs_path, None)
+        return result
 
     def construct_yaml_map(self, node):
-        data = OrderedDict()
+        data: dict = {}
         yield data
         value = self.construct_mapping(node)
         data.update(value)
 
     def construct_mapping(self, node, deep=False):
         if isinstance(node, yaml.MappingNode):
-            self.flatten_mapping(node)
+            # flatten_mapping is only needed to handle merge (<<) and value
+            # (=) keys, avoid walking the mapping when there are none
+            if any(key_node.tag in FLATTEN_TAGS for key_node, _ in node.value):
+                self.flatten_mapping(node)
         else:
             raise yaml.constructor.ConstructorError(
                 context=None,
@@ -82,18 +199,22 @@ class OrderedDictYAMLLoader(Loader):
                 problem_mark=node.start_mark,
             )
 
-        mapping = OrderedDict()
+        mapping: dict = {}
         for key_node, value_node in node.value:
-            key = self.construct_object(key_node, deep=deep)
-            try:
-                hash(key)
-            except TypeError as exc:
-                raise yaml.constructor.ConstructorError(
-                    context="while constructing a mapping",
-                    context_mark=node.start_mark,
-                    problem=f"found unacceptable key ({exc})",
-                    problem_mark=key_node.start_mark,
-                ) from exc
+            if key_node.tag == STR_TAG and isinstance(key_node, yaml.ScalarNode):
+                # Most keys are strings, which are always hashable
+                key = self.construct_yaml_str(key_node)
+            else:
+                key = self.construct_object(key_node, deep=deep)
+                try:
+                    hash(key)
+                except TypeError as exc:
+                    raise yaml.constructor.ConstructorError(
+                        context="while constructing a mapping",
+                        context_mark=node.start_mark,
+                        problem=f"found unacceptable key ({exc})",
+                        problem_mark=key_node.start_mark,
+                    ) from exc
             value = self.construct_object(value_node, deep=deep)
             if key in mapping:
                 raise yaml.constructor.ConstructorError(
@@ -106,14 +227,14 @@ class OrderedDictYAMLLoader(Loader):
         return mapping
 
 
-def load_ordered(filename: str) -> OrderedDict:
+def load_ordered(filename: str) -> dict:
     """Load a .yaml file, keep the file order."""
-    with open(filename) as f:
+    with open(filename, "rb") as f:
         return yaml.load(f, OrderedDictYAMLLoader)
 
 
 class CaseParser:
-    """Parse case statements in an OrderedDict.
+    """Parse case statements in a dictionary.
 
     Each time a key starting with ``case_`` (or the prefix you choose) if
     found, in a block mapping, the value of the sub block matching the key
@@ -152,7 +273,9 @@ class CaseParser:
     """
 
     def __init__(self, initial_config: dict, case_prefix: str = "case_"):
-        self.__state = initial_config.copy()
+        # Updates are recorded in the first map of the chain so that
+        # initial_config does not need to be copied.
+        self.__state: ChainMap[str, Any] = ChainMap({}, initial_config)
         self.case_prefix = case_prefix
 
         # This contains the list of keys that have been updated. This
@@ -160,25 +283,40 @@ class CaseParser:
         # not modified.
         self.keys: set[str] = set()
 
-    def __parse_case(self, case_key: str, data: dict) -> Any:
+        # Cache of the compiled case regexps, indexed by regexp source. The
+        # case values cannot be used as keys as values such as True and 1
+        # are equal but give different regexps.
+        self.__re_cache: dict[str, re.Pattern] = {}
+
+        # Cache of the keys referenced by each template string, and of the
+        # templates escaped for a given set of available keys
+        self.__tmpl_refs: dict[str, frozenset[str]] = {}
+        self.__tmpl_cache: dict[tuple[str, frozenset[str]], str] = {}
+
+        # Whether the location of updated keys should be computed for
+        # debug logging. This is set each time parse is called.
+        self.__debug = False
+
+    def __parse_case(self, key: str, data: dict) -> Any:
         """Parse a case statement.
 
-        :param case_key: the variable on which the case is evaluated
+        :param key: the variable on which the case is evaluated (the case key
+            without the case prefix)
         :param data: the dictionary of case conditions
 
         :return: the value of the matched element or None
         """
-        key = case_key[len(self.case_prefix) :]
         key_val = str(self.__state[key])
 
-        result = next(
-            ((key_val, k, data[k]) for k in data if re.match(f"^{k}$", key_val)), None
-        )
-        if result is not None:
-            e3.log.debug("%s=%s match %s", key, result[0], result[1])
-            return result[2]
-        else:
-            return None
+        for k in data:
+            source = f"^{k}\\Z"
+            pattern = self.__re_cache.get(source)
+            if pattern is None:
+                pattern = self.__re_cache[source] = re.compile(source)
+            if pattern.match(key_val):
+                e3.log.debug("%s=%s match %s", key, key_val, k)
+                return data[k]
+        return None
 
     def __format_value(self, value: Any) -> Any:
         """Format a value.
@@ -189,7 +327,7 @@ class CaseParser:
         """
         try:
             if isinstance(value, str):
-                return format_with_dict(value, self.__state)
+                return self.__format_str(value)
             elif isinstance(value, dict):
                 return {k: self.__format_value(v) for k, v in value.items()}
             elif isinstance(value, list):
@@ -199,19 +337,58 @@ class CaseParser:
 
         return value
 
-    def __update_state(self, key: str, value: Any, cursor: Any, prefix: tuple) -> None:
+    def __format_str(self, value: str) -> str:
+        """Format a string using the current state.
+
+        This is equivalent to ``format_with_dict(value, self.__state)`` but
+        the escaped template is computed only once for a given set of
+        available keys.
+
+        :param value: the string to be formatted
+
+        :return: the result of the expansion
+        """
+        if "%(" not in value:
+            return value
+
+        refs = self.__tmpl_refs.get(value)
+        if refs is None:
+            refs = self.__tmpl_refs[value] = frozenset(FORMAT_KEY_RE.findall(value))
+        known = frozenset(k for k in refs if k in self.__state)
+
+        template = self.__tmpl_cache.get((value, known))
+        if template is None:
+            # Escape all % that do not introduce a reference to a known key
+            if known:
+                key_regexp = "|".join(re.escape(f"({k})") for k in known)
+                template = re.sub(f"%(?!{key_regexp})", "%%", value)
+            else:
+                template = value.replace("%", "%%")
+            self.__tmpl_cache[(value, known)] = template
+        return template % self.__state
+
+    def __update_state(
+        self,
+        key_op: tuple[bool, bool],
+        real_key: str,
+        value: Any,
+        cursor: Any,
+        prefix: tuple,
+    ) -> None:
         """Update state.
 
-        :param key: the key to modify. Leading or trailing '+' in the key name
-            are interpreted respectively as append and prepend operators.
-            For dictionaries these operators are interpreted as an update
-            on the original value.
+        :param key_op: whether the key to modify starts and ends with a '+'.
+            Leading or trailing '+' in the key name are interpreted
+            respectively as append and prepend operators. For dictionaries
+            these operators are interpreted as an update on the original
+            value.
+        :param real_key: the key to modify stripped from its '+' operators
         :param value: the new value
         :param cursor: the object to be updated
         :param prefix: a tuple of string that gives the position of cursor in
-            self.__state. This is used only for debugging purposes
+            self.__state. This is used only for debugging purposes and is
+            empty when debug logging is disabled
         """
-        real_key = key.strip("+")
         real_value = self.__format_value(value)
 
         # Update the list of keys that should be considered in the final
@@ -219,39 +396,55 @@ class CaseParser:
         if cursor is self.__state:
             self.keys.add(real_key)
 
-        real_key_str = "[%s]" % "][".join(prefix + (real_key,))
+        if self.__debug:
+            real_key_str = "[%s]" % "][".join(prefix + (real_key,))
+        else:
+            real_key_str = real_key
 
-        if real_key not in cursor or real_key == key:
+        update_op = UPDATE_OPERATORS.get(key_op)
+        if update_op is None or real_key not in cursor:
             e3.log.debug("set %s -> %s", real_key_str, real_value)
             cursor[real_key] = real_value
+        elif isinstance(cursor[real_key], dict):
+            e3.log.debug("update %s -> %s", real_key_str, real_value)
+            updated_value = cursor[real_key]
+            updated_value.update(real_value)
+            # Assign the value back so that the key is recorded in the
+            # updated keys of the state
+            cursor[real_key] = updated_value
         else:
-            if isinstance(cursor[real_key], dict):
-                e3.log.debug("update %s -> %s", real_key_str, real_value)
-                cursor[real_key].update(real_value)
-            else:
-                if key.startswith("+"):
-                    e3.log.debug("append %s -> %s", real_key_str, real_value)
-                    cursor[real_key] = cursor[real_key] + real_value
-                elif key.endswith("+"):
-                    e3.log.debug("prepend %s -> %s", real_key_str, real_value)
-                    cursor[real_key] = real_value + cursor[real_key]
+            op_name, op = update_op
+            e3.log.debug("%s %s -> %s", op_name, real_key_str, real_value)
+            cursor[real_key] = op(cursor[real_key], real_value)
+
+    def __result(self) -> dict:
+        """Return the keys of the state that have been updated.
+
+        Keys part of the initial config come first, in the initial config
+        order, followed by the new keys in the order they were added.
+        """
+        updates, initial_config = self.__state.maps
+        result = {k: updates[k] for k in initial_config if k in updates}
+        result.update(updates)
+        return result
 
     def parse(self, data: Any) -> Any:
         """Parse.
 
         :param data: a python object. Note that dictionaries in that structure
-            should be OrderedDict.
+            should preserve the order of the keys in the yaml file.
 
         :return: a new python object after expansion of case statements and
             formatting of values
         """
+        self.__debug = e3.log.e3_debug_logger.isEnabledFor(logging.DEBUG)
         return self.__parse(data, self.__state, ())
 
     def __parse(self, data: Any, cursor: Any, prefix: tuple) -> Any:
         """Parse (internal).
 
         :param data: a python object. Note that dictionaries in that structure
-            should be OrderedDict.
+            should preserve the order of the keys in the yaml file.
         :param cursor: a ref to a substructure of self.__state
         :param prefix: the current location in self.__state (a tuple of keys)
 
@@ -260,28 +453,73 @@ class CaseParser:
         if not isinstance(data, dict):
             return self.__format_value(data)
 
-        for key in data:
-            if key.startswith(self.case_prefix):
-                pc = self.__parse_case(key, data[key])
-                if pc is not None:
-                    result = self.__parse(pc, cursor, prefix)
-                    if not isinstance(result, dict):
-                        assert len(list(data.keys())) == 1, "invalid configuration file"
-                        return result
+        # The structure is walked using an explicit stack rather than
+        # recursive calls. Each entry contains a dictionary being parsed,
+        # the iterator on its remaining keys, its cursor and prefix, and the
+        # operators and name of the key whose value is being parsed. The
+        # operators are None when the value being parsed comes from a case
+        # statement.
+        stack: list[
+            tuple[dict, Iterator, Any, tuple, tuple[bool, bool] | None, str]
+        ] = []
+        keys = iter(data)
+        case_prefix = self.case_prefix
+        case_prefix_len = len(case_prefix)
+
+        while True:
+            pushed = False
+            for key in keys:
+                if key[:case_prefix_len] == case_prefix:
+                    pc = self.__parse_case(key[case_prefix_len:], data[key])
+                    if pc is None:
+                        continue
+                    elif isinstance(pc, dict):
+                        stack.append((data, keys, cursor, prefix, None, ""))
+                        data, keys = pc, iter(pc)
+                        pushed = True
+                        break
+                    else:
+                        assert len(data) == 1, "invalid configuration file"
+                        result = self.__format_value(pc)
+                        break
+                else:
+                    real_key = key.strip("+")
+                    key_op = (key[:1] == "+", key[-1:] == "+")
+                    value = data[key]
+                    if isinstance(value, dict):
+                        stack.append((data, keys, cursor, prefix, key_op, real_key))
+                        data, keys = value, iter(value)
+                        cursor = cursor.get(real_key, {})
+                        if self.__debug:
+                            prefix = prefix + (real_key,)
+                        pushed = True
+                        break
+                    self.__update_state(
+                        key_op, real_key, self.__format_value(value), cursor, prefix
+                    )
             else:
-                subcursor = cursor.get(key.strip("+"), {})
-                subprefix = prefix + (key.strip("+"),)
-                self.__update_state(
-                    key,
-                    self.__parse(data[key], cursor=subcursor, prefix=subprefix),
-                    cursor,
-                    prefix,
-                )
-
-        if cursor is self.__state:
-            return {k: v for k, v in cursor.items() if k in self.keys}
-        else:
-            return cursor
+                if cursor is self.__state:
+                    result = self.__result()
+                else:
+                    result = cursor
+
+            if pushed:
+                continue
+
+            # The current dictionary has been parsed, give its result back to
+            # the enclosing dictionaries.
+            while True:
+                if not stack:
+                    return result
+                data, keys, cursor, prefix, pending_op, real_key = stack.pop()
+                if pending_op is not None:
+                    self.__update_state(pending_op, real_key, result, cursor, prefix)
+                    break
+                elif isinstance(result, dict):
+                    break
+                # A case statement returned a value that is not a dictionary,
+                # it then replaces the enclosing dictionary
+                assert len(data) == 1, "invalid configuration file"
 
 
 def load_with_config(filename: str | list[str], config: dict) -> Any:
@@ -339,14 +577,25 @@ def load_with_regexp_table(filename: str, selectors: list[str], data: dict) -> d
     elements.
     """
     e3.log.debug("load %s with %s", filename, selectors)
-    with open(filename) as f:
-        conf_data = yaml.load(f.read(), OrderedDictYAMLLoader)
+    with open(filename, "rb") as f:
+        conf_data = yaml.load(f, OrderedDictYAMLLoader)
 
     assert isinstance(
         conf_data, dict
     ), f"top level object in {filename} should be a dict"
 
     result = {}
+    # Compiled regexps, indexed by regexp source
+    regexps: dict[str, re.Pattern] = {}
+    selector_values = [str(selector) for selector in selectors]
+
+    def regexp(r: str) -> re.Pattern:
+        """Return the compiled version of a table regexp."""
+        source = rf"^{r or '.*'}$"
+        pattern = regexps.get(source)
+        if pattern is None:
+            pattern = regexps[source] = re.compile(source)
+        return pattern
 
     for key in conf_data:
         key_data = conf_data[key]
@@ -358,25 +607,19 @@ def load_with_regexp_table(filename: str, selectors: list[str], data: dict) -> d
             ), f"value for key {key} should be a list of list"
             assert len(line) == len(selectors) + 1
 
-            has_matched = True
-            for index, r in enumerate(line[0:-1]):
-                if len(r) == 0:
-                    r = ".*"
-                if not re.search(rf"^{r}$", str(selectors[index])):
-                    has_matched = False
-
-            if has_matched:
-                result[key] = line[-1]
+            if all(
+                regexp(r).search(selector)
+                for r, selector in zip(line[0:-1], selector_values)
+            ):
+                # Use data to replace %()s strings
+                value = line[-1]
+                if isinstance(value, str):
+                    if "%" in value:
+                        value = value % data
+                elif isinstance(value, list):
+                    value = [k % data if "%" in k else k for k in value]
+                result[key] = value
                 break
 
-    # At this stage we have our dictionary filled. Now use data to replace to
-    # replace %()s strings.
-
-    for key in result:
-        if isinstance(result[key], str):
-            result[key] = result[key] % data
-        elif isinstance(result[key], list):
-            result[key] = [k % data for k in result[key]]
-
     e3.log.debug("yaml results: %s", result)
     return result
@@ -180,3 +180,221 @@ def test_load_with_regexp():
     assert result["key1"] == "TRUE"
     assert result["key2"][0] == "TRUE"
     assert result["key2"][1] == "TRUE"
+
+
+def test_case_parser_anchored():
+    """Case values must match the whole variable value."""
+    yaml_case_content = """
+case_v:
+    'ful':
+        r: partial
+    'full':
+        r: full
+"""
+    d = yaml.load(StringIO(yaml_case_content), e3.yaml.OrderedDictYAMLLoader)
+    assert e3.yaml.CaseParser({"v": "full"}).parse(d) == {"r": "full"}
+    assert e3.yaml.CaseParser({"v": "full\n"}).parse(d) == {}
+
+
+def test_case_parser_format():
+    """Check that % not referencing a known key are preserved."""
+    yaml_case_content = """
+a: '100%'
+b: '%(v)s at 50%'
+c: '%(unknown)s and %(v)s'
+d: ['%(v)s', '%(v)s%%']
+"""
+    d = yaml.load(StringIO(yaml_case_content), e3.yaml.OrderedDictYAMLLoader)
+    parse_it = e3.yaml.CaseParser({"v": "ok"}).parse(d)
+    assert parse_it == {
+        "a": "100%",
+        "b": "ok at 50%",
+        "c": "%(unknown)s and ok",
+        "d": ["ok", "ok%%"],
+    }
+
+
+def test_merge_key():
+    """Merge keys are supported by load_ordered."""
+    with open("merge.yaml", "w") as f:
+        f.write("base: &base {a: 1, b: 2}\nderived:\n  <<: *base\n  c: 3\n")
+
+    d = e3.yaml.load_ordered("merge.yaml")
+    assert d["derived"] == {"a": 1, "b": 2, "c": 3}
+
+
+def test_include_cache():
+    """Included files are cached until they are modified."""
+    with open("1.yaml", "w") as f:
+        f.write("b: !include 2.yaml\nc: !include 2.yaml\n")
+
+    with open("2.yaml", "w") as f:
+        f.write("a: [4]\n")
+
+    d = e3.yaml.load_ordered("1.yaml")
+    assert d == {"b": {"a": [4]}, "c": {"a": [4]}}
+
+    # Returned values are copies of the cached ones
+    d["b"]["a"].append(5)
+    assert d["c"] == {"a": [4]}
+    assert e3.yaml.load_ordered("1.yaml") == {"b": {"a": [4]}, "c": {"a": [4]}}
+
+    with open("2.yaml", "w") as f:
+        f.write("a: [4, 2]\n")
+    assert e3.yaml.load_ordered("1.yaml") == {
+        "b": {"a": [4, 2]},
+        "c": {"a": [4, 2]},
+    }
+
+    os.environ["E3_ENABLE_FEATURE"] = "no-yaml-include-cache"
+    assert e3.yaml.load_ordered("1.yaml")["b"] == {"a": [4, 2]}
+
+
+def test_case_parser_initial_config():
+    """The initial config is not modified by the parser."""
+    config = {"v": "full", "l": ["a"]}
+    d = {"+l": ["b"], "r": "%(v)s"}
+    assert e3.yaml.CaseParser(config).parse(d) == {"l": ["a", "b"], "r": "full"}
+    assert config == {"v": "full", "l": ["a"]}
+
+
+def test_load_with_config_multiple_files():
+    """Config files are applied in order."""
+    with open("c1.yaml", "w") as f:
+        f.write("a: 1\nb: '%(v)s'\nl: [1]\n")
+    with open("c2.yaml", "w") as f:
+        f.write("case_v:\n  full:\n    a: 2\n+l: [2]\n")
+    with open("c3.yaml", "w") as f:
+        f.write("c: '%(a)s'\n")
+
+    assert e3.yaml.load_with_config(
+        ["c1.yaml", "c2.yaml", "c3.yaml"], {"v": "full"}
+    ) == {
+        "a": 2,
+        "b": "full",
+        "c": "2",
+        "l": [1, 2],
+    }
+
+    with pytest.raises(e3.yaml.YamlError) as err:
+        e3.yaml.load_with_config(["c1.yaml", "/does/not/exist"], {})
+    assert "cannot read: /does/not/exist" in str(err.value)
+
+
+def test_scalars():
+    """Check yaml scalars loading."""
+    d = yaml.load(
+        StringIO(
+            "a: 12\nb: -3\nc: 012\nd: 0x1f\ne: 1_000\nf: '12'\n"
+            "g: text\nh: !!str 4\ni: 1:30\nj: true\n"
+        ),
+        e3.yaml.OrderedDictYAMLLoader,
+    )
+    assert d == {
+        "a": 12,
+        "b": -3,
+        "c": 10,
+        "d": 31,
+        "e": 1000,
+        "f": "12",
+        "g": "text",
+        "h": "4",
+        "i": 90,
+        "j": True,
+    }
+
+    with pytest.raises(yaml.constructor.ConstructorError):
+        yaml.load(StringIO("!!str [1]"), e3.yaml.OrderedDictYAMLLoader)
+
+    # Short strings are interned
+    d = yaml.load(StringIO("[{key: v}, {key: v}]"), e3.yaml.OrderedDictYAMLLoader)
+    assert list(d[0])[0] is list(d[1])[0]
+    assert d[0]["key"] is d[1]["key"]
+
+
+def test_case_parser_deep():
+    """Deeply nested structures do not hit the recursion limit."""
+    d = {"r": 1}
+    for _ in range(5000):
+        d = {"case_v": {".*": d}}
+    assert e3.yaml.CaseParser({"v": "x"}).parse(d) == {"r": 1}
+
+
+def test_mapping_keys():
+    """Check yaml mapping keys loading."""
+    d = yaml.load(
+        StringIO("a: 1\n2: b\n'3': c\n? !!python/tuple [1, 2]\n: d\n"),
+        e3.yaml.OrderedDictYAMLLoader,
+    )
+    assert d == {"a": 1, 2: "b", "3": "c", (1, 2): "d"}
+
+
+def test_include_not_copyable():
+    """Included files with objects that cannot be copied are not cached."""
+    with open("1.yaml", "w") as f:
+        f.write("b: !include 2.yaml\nc: !include 2.yaml\n")
+
+    with open("2.yaml", "w") as f:
+        f.write("m: !!python/module:os\n")
+
+    d = e3.yaml.load_ordered("1.yaml")
+    assert d == {"b": {"m": os}, "c": {"m": os}}
+
+
+def test_case_parser_key_order():
+    """Keys from the initial config come first in the result."""
+    d = {"c": 1, "v": "%(v)s", "a": 2}
+    parse_it = e3.yaml.CaseParser({"w": 0, "v": "x"}).parse(d)
+    assert list(parse_it) == ["v", "c", "a"]
+
+
+def test_load_with_regexp_alternation():
+    """Table regexps are anchored as ^regexp$."""
+    with open("regexp2.yaml", "w") as f:
+        f.write("key1: [['a|b', 'hit'], ['', 'miss']]\n")
+        f.write("key2: [['a', 'hit'], ['', 'miss']]\n")
+
+    result = e3.yaml.load_with_regexp_table(
+        filename="regexp2.yaml", selectors=["xb"], data={}
+    )
+    assert result == {"key1": "hit", "key2": "miss"}
+
+
+def test_case_parser_equal_values():
+    """Case values that are equal but have different regexps are distinct."""
+    yaml_case_content = """
+case_v:
+    true:
+        r: t
+case_w:
+    1:
+        s: one
+"""
+    d = yaml.load(StringIO(yaml_case_content), e3.yaml.OrderedDictYAMLLoader)
+    parse_it = e3.yaml.CaseParser({"v": "True", "w": "1"}).parse(d)
+    assert parse_it == {"r": "t", "s": "one"}
+
+    with open("regexp3.yaml", "w") as f:
+        f.write("key1: [[true, 'hit'], ['', 'miss']]\n")
+        f.write("key2: [[1, 'hit'], ['', 'miss']]\n")
+
+    result = e3.yaml.load_with_regexp_table(
+        filename="regexp3.yaml", selectors=["1"], data={}
+    )
+    assert result == {"key1": "miss", "key2": "hit"}
+
+
+def test_include_cache_nested():
+    """Cached included files are reloaded when a nested include changes."""
+    with open("a.yaml", "w") as f:
+        f.write("x: !include b.yaml\n")
+    with open("b.yaml", "w") as f:
+        f.write("y: !include c.yaml\n")
+    with open("c.yaml", "w") as f:
+        f.write("z: 1\n")
+
+    assert e3.yaml.load_ordered("a.yaml") == {"x": {"y": {"z": 1}}}
+
+    with open("c.yaml", "w") as f:
+        f.write("z: 22\n")
+    assert e3.yaml.load_ordered("a.yaml") == {"x": {"y": {"z": 22}}}